@@ -13,13 +13,16 @@ CORS(app)
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 GENERATED_FOLDER = 'generated'
+STAGING_FOLDER = 'staging'  # Greetings are built here, then renamed into GENERATED_FOLDER
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 LINK_EXPIRY_DAYS = 2  # Links valid for 2 days
+ORPHAN_MAX_AGE_SECONDS = 60 * 60  # Leftovers from crashed builds are reaped after 1 hour
 
 # Create required directories
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(GENERATED_FOLDER, exist_ok=True)
+os.makedirs(STAGING_FOLDER, exist_ok=True)
 
 # Template configurations
 TEMPLATE_CONFIGS = {
@@ -68,9 +71,9 @@ def get_expiry_date(created_at):
         created_at = datetime.fromisoformat(created_at)
     return created_at + timedelta(days=LINK_EXPIRY_DAYS)
 
-def save_greeting_metadata(greeting_id, data):
+def save_greeting_metadata(greeting_folder, data):
     """Save metadata for a greeting including expiry info"""
-    metadata_path = os.path.join(GENERATED_FOLDER, greeting_id, 'metadata.json')
+    metadata_path = os.path.join(greeting_folder, 'metadata.json')
     with open(metadata_path, 'w') as f:
         json.dump(data, f, indent=2)
 
@@ -82,6 +85,128 @@ def load_greeting_metadata(greeting_id):
             return json.load(f)
     return None
 
+def publish_greeting(staging_folder, greeting_id):
+    """Atomically move a fully built greeting from staging into place"""
+    os.rename(staging_folder, os.path.join(GENERATED_FOLDER, greeting_id))
+
+def remove_greeting(greeting_id):
+    """Delete a greeting without exposing a half-deleted folder to readers"""
+    greeting_folder = os.path.join(GENERATED_FOLDER, greeting_id)
+
+    # Security check - only ever move direct children of GENERATED_FOLDER
+    if os.path.dirname(os.path.abspath(greeting_folder)) != os.path.abspath(GENERATED_FOLDER):
+        return False
+
+    trash_folder = os.path.join(STAGING_FOLDER, f'{greeting_id}.deleting-{uuid.uuid4()}')
+    try:
+        os.rename(greeting_folder, trash_folder)
+    except FileNotFoundError:
+        # Already removed by another request
+        return False
+    shutil.rmtree(trash_folder, ignore_errors=True)
+    return True
+
+def is_orphan_stale(path):
+    """Check if a leftover folder is old enough that no build still owns it"""
+    # ctime rather than mtime: copytree copies the template's mtime onto the new folder
+    try:
+        age = datetime.now().timestamp() - os.path.getctime(path)
+    except FileNotFoundError:
+        return False
+    return age > ORPHAN_MAX_AGE_SECONDS
+
+def reap_orphans():
+    """Remove stale staging folders and published folders without metadata"""
+    removed = []
+
+    for entry in os.listdir(STAGING_FOLDER):
+        path = os.path.join(STAGING_FOLDER, entry)
+        if os.path.isdir(path) and is_orphan_stale(path):
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(entry)
+
+    # Greetings built before staged writes could be left half-written
+    for greeting_id in os.listdir(GENERATED_FOLDER):
+        path = os.path.join(GENERATED_FOLDER, greeting_id)
+        if (os.path.isdir(path)
+                and not os.path.exists(os.path.join(path, 'metadata.json'))
+                and is_orphan_stale(path)
+                and remove_greeting(greeting_id)):
+            removed.append(greeting_id)
+
+    return removed
+
+def build_greeting(template_id, template_config, greeting_id, greeting_folder, name, message):
+    """Build a customized greeting in greeting_folder and return its metadata"""
+    uploaded_files = []
+
+    # Copy template files
+    template_source = template_config['folder']
+    copy_directory(template_source, greeting_folder)
+
+    # Handle uploaded files
+    if template_id == 'template1':
+        user_image = request.files['user_image']
+        ext = os.path.splitext(user_image.filename)[1].lower()
+        new_filename = f'user_photo{ext}'
+        user_image.save(os.path.join(greeting_folder, new_filename))
+        uploaded_files.append(new_filename)
+
+    if template_id == 'template2':
+        images = request.files.getlist('images')
+        for i, img in enumerate(images):
+            ext = os.path.splitext(img.filename)[1].lower()
+            new_filename = f'custom_image_{i + 1}{ext}'
+            img.save(os.path.join(greeting_folder, new_filename))
+            uploaded_files.append(new_filename)
+
+    # Customize HTML
+    html_path = os.path.join(greeting_folder, 'index.html')
+    with open(html_path, 'r', encoding='utf-8') as f:
+        html_content = f.read()
+
+    # Apply customizations
+    if template_id == 'template1':
+        html_content = html_content.replace('{{USER_NAME}}', name)
+        html_content = html_content.replace('{{USER_IMAGE}}', uploaded_files[0])
+        html_content = html_content.replace('{{BIRTHDAY_MESSAGE}}', message)
+    elif template_id == 'template2':
+        html_content = html_content.replace('{{USER_NAME}}', name)
+        for i, filename in enumerate(uploaded_files):
+            html_content = html_content.replace(f'./images/r{i + 1}.png', filename)
+            html_content = html_content.replace(f'./images/r{i + 1}.jpg', filename)
+    elif template_id == 'template3':
+        html_content = html_content.replace('{{USER_NAME}}', name)
+        html_content = html_content.replace('{{BIRTHDAY_MESSAGE}}', message)
+
+    # Add base tag
+    base_tag = f'<base href="/greeting/{greeting_id}/">'
+    if '<head>' in html_content:
+        html_content = html_content.replace('<head>', f'<head>\n    {base_tag}')
+    elif '<HEAD>' in html_content:
+        html_content = html_content.replace('<HEAD>', f'<HEAD>\n    {base_tag}')
+
+    # Save customized HTML
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write(html_content)
+
+    # Save metadata with expiry info
+    created_at = datetime.now()
+    expiry_date = get_expiry_date(created_at)
+
+    metadata = {
+        'greeting_id': greeting_id,
+        'template_id': template_id,
+        'recipient_name': name,
+        'created_at': created_at.isoformat(),
+        'expires_at': expiry_date.isoformat(),
+        'uploaded_files': uploaded_files,
+        'valid_for_days': LINK_EXPIRY_DAYS
+    }
+    save_greeting_metadata(greeting_folder, metadata)
+
+    return metadata
+
 # Routes
 
 @app.route('/')
@@ -153,8 +278,6 @@ def generate_greeting():
             }), 400
 
         # Template-specific validations
-        uploaded_files = []
-
         if template_id == 'template1':
             if 'user_image' not in request.files:
                 return jsonify({
@@ -199,73 +322,20 @@ def generate_greeting():
 
         # Generate unique ID
         greeting_id = str(uuid.uuid4())
-        greeting_folder = os.path.join(GENERATED_FOLDER, greeting_id)
-
-        # Copy template files
-        template_source = template_config['folder']
-        copy_directory(template_source, greeting_folder)
 
-        # Handle uploaded files
-        if template_id == 'template1':
-            user_image = request.files['user_image']
-            ext = os.path.splitext(user_image.filename)[1].lower()
-            new_filename = f'user_photo{ext}'
-            user_image.save(os.path.join(greeting_folder, new_filename))
-            uploaded_files.append(new_filename)
+        # Build in staging so readers never see a half-written greeting
+        greeting_folder = os.path.join(STAGING_FOLDER, greeting_id)
+        try:
+            metadata = build_greeting(template_id, template_config, greeting_id, greeting_folder, name, message)
+            publish_greeting(greeting_folder, greeting_id)
+        except Exception:
+            shutil.rmtree(greeting_folder, ignore_errors=True)
+            raise
 
-        if template_id == 'template2':
-            images = request.files.getlist('images')
-            for i, img in enumerate(images):
-                ext = os.path.splitext(img.filename)[1].lower()
-                new_filename = f'custom_image_{i + 1}{ext}'
-                img.save(os.path.join(greeting_folder, new_filename))
-                uploaded_files.append(new_filename)
-
-        # Customize HTML
-        html_path = os.path.join(greeting_folder, 'index.html')
-        with open(html_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-
-        # Apply customizations
-        if template_id == 'template1':
-            html_content = html_content.replace('{{USER_NAME}}', name)
-            html_content = html_content.replace('{{USER_IMAGE}}', uploaded_files[0])
-            html_content = html_content.replace('{{BIRTHDAY_MESSAGE}}', message)
-        elif template_id == 'template2':
-            html_content = html_content.replace('{{USER_NAME}}', name)
-            for i, filename in enumerate(uploaded_files):
-                html_content = html_content.replace(f'./images/r{i + 1}.png', filename)
-                html_content = html_content.replace(f'./images/r{i + 1}.jpg', filename)
-        elif template_id == 'template3':
-            html_content = html_content.replace('{{USER_NAME}}', name)
-            html_content = html_content.replace('{{BIRTHDAY_MESSAGE}}', message)
-
-        # Add base tag
-        base_tag = f'<base href="/greeting/{greeting_id}/">'
-        if '<head>' in html_content:
-            html_content = html_content.replace('<head>', f'<head>\n    {base_tag}')
-        elif '<HEAD>' in html_content:
-            html_content = html_content.replace('<HEAD>', f'<HEAD>\n    {base_tag}')
-
-        # Save customized HTML
-        with open(html_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-
-        # Save metadata with expiry info
-        created_at = datetime.now()
+        uploaded_files = metadata['uploaded_files']
+        created_at = datetime.fromisoformat(metadata['created_at'])
         expiry_date = get_expiry_date(created_at)
 
-        metadata = {
-            'greeting_id': greeting_id,
-            'template_id': template_id,
-            'recipient_name': name,
-            'created_at': created_at.isoformat(),
-            'expires_at': expiry_date.isoformat(),
-            'uploaded_files': uploaded_files,
-            'valid_for_days': LINK_EXPIRY_DAYS
-        }
-        save_greeting_metadata(greeting_id, metadata)
-
         # Generate greeting URL
         greeting_url = f"{request.scheme}://{request.host}/greeting/{greeting_id}"
 
@@ -306,7 +376,7 @@ def view_greeting(greeting_id):
         created_at = metadata.get('created_at')
         if created_at and is_greeting_expired(created_at):
             # Delete expired greeting
-            shutil.rmtree(greeting_folder, ignore_errors=True)
+            remove_greeting(greeting_id)
 
             # Return expired message
             return render_template_string('''
@@ -417,10 +487,8 @@ def get_greeting_info(greeting_id):
 @app.route('/api/greeting/<greeting_id>', methods=['DELETE'])
 def delete_greeting(greeting_id):
     """Delete a greeting"""
-    greeting_folder = os.path.join(GENERATED_FOLDER, greeting_id)
-
     try:
-        shutil.rmtree(greeting_folder, ignore_errors=True)
+        remove_greeting(greeting_id)
         return jsonify({
             'success': True,
             'message': f'Greeting {greeting_id} deleted successfully'
@@ -433,7 +501,7 @@ def delete_greeting(greeting_id):
 
 @app.route('/api/cleanup-expired', methods=['POST'])
 def cleanup_expired():
-    """Cleanup all expired greetings"""
+    """Cleanup all expired greetings and orphans left by failed builds"""
     deleted_count = 0
     errors = []
 
@@ -448,14 +516,17 @@ def cleanup_expired():
                     created_at = metadata.get('created_at')
                     if created_at and is_greeting_expired(created_at):
                         try:
-                            shutil.rmtree(greeting_folder)
-                            deleted_count += 1
+                            if remove_greeting(greeting_id):
+                                deleted_count += 1
                         except Exception as e:
                             errors.append(f'{greeting_id}: {str(e)}')
 
+        orphans_removed = reap_orphans()
+
         return jsonify({
             'success': True,
             'deleted_count': deleted_count,
+            'orphans_removed': len(orphans_removed),
             'errors': errors if errors else None
         })
 